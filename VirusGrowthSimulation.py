@@ -1,19 +1,98 @@
+import os
 import random
+from concurrent.futures import ProcessPoolExecutor
+import numpy as np
 import pylab
 import sys
 
 class NoChildException(Exception):
     """
-    NoChildException is raised by the reproduce() method in the SimpleVirus
-    and ResistantVirus classes to indicate that a virus particle does not
-    reproduce.
+    NoChildException used to be raised by the reproduce() method in the
+    SimpleVirus and ResistantVirus classes to indicate that a virus particle
+    does not reproduce. reproduce() now returns None instead and no longer
+    raises it; the class is kept so code that catches it keeps working.
     """
+
+drugIndex = {}
+"""
+Maps each drug name (a string) to the bit position that represents it in a
+resistance bitmask. A position is assigned the first time a drug is seen.
+"""
+
+def getDrugMask(drugs):
+    """
+    Builds the bitmask of a group of drugs, registering in drugIndex any drug
+    that was not seen before.
+
+    drugs: the drug names (an iterable of strings)
+
+    returns: an integer with the bit of every drug in drugs set.
+    """
+    index = drugIndex
+    mask = 0
+    for drug in drugs:
+        bit = index.get(drug)
+        if bit is None:
+            if len(index) == 64:
+                raise ValueError("At most 64 different drugs can be tracked")
+            bit = index[drug] = len(index)
+        mask |= 1 << bit
+    return mask
+
+
+def findDrugMask(drugs):
+    """
+    Builds the bitmask of a group of drugs without registering anything in
+    drugIndex. Used by queries, so that a drug name no virus has ever been
+    built with does not take one of the 64 bits.
+
+    drugs: the drug names (an iterable of strings)
+
+    returns: an integer with the bit of every drug in drugs set, or None if
+    some drug is not in drugIndex (no virus can be resistant to it).
+    """
+    index = drugIndex
+    mask = 0
+    for drug in drugs:
+        bit = index.get(drug)
+        if bit is None:
+            return None
+        mask |= 1 << bit
+    return mask
+
+
+def getTraitBits(mask):
+    """
+    Splits a bitmask into its set bits.
+
+    mask: a bitmask of drugs (an integer)
+
+    returns: a numpy uint64 array with one entry per bit set in mask, in
+    increasing bit order.
+    """
+    return np.array([1 << bit for bit in sorted(drugIndex.values())
+                     if (mask >> bit) & 1], dtype=np.uint64)
+
+
+def loadDrugIndex(index):
+    """
+    Replaces the contents of drugIndex with index. Used as the initializer of
+    the worker processes so they assign the same bit to every drug as the
+    process that built the viruses.
+
+    index: a dictionary of drug names (strings) mapping to bit positions
+    """
+    drugIndex.clear()
+    drugIndex.update(index)
+
     
 class SimpleVirus(object):
 
     """
     Representation of a simple virus (does not model drug effects/resistance).
     """
+    __slots__ = ('maxBirthProb', 'clearProb')
+
     def __init__(self, maxBirthProb, clearProb):
         """
         Initialize a SimpleVirus instance, saves all parameters as attributes
@@ -37,20 +116,22 @@ class SimpleVirus(object):
         """
         return self.clearProb
 
-    def doesClear(self):
+    def doesClear(self, rng=random):
         """ Stochastically determines whether this virus particle is cleared from the
         patient's body at a time step. 
+        rng: the source of the random numbers (anything with a random()
+        method, e.g. the random module, a random.Random or a numpy Generator)
         returns: True with probability self.getClearProb and otherwise returns
         False.
         """
 
-        if self.clearProb >= random.random():
+        if self.clearProb >= rng.random():
             return True
         else:
             return False
 
     
-    def reproduce(self, popDensity):
+    def reproduce(self, popDensity, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the Patient and
@@ -63,17 +144,20 @@ class SimpleVirus(object):
 
         popDensity: the population density (a float), defined as the current
         virus population divided by the maximum population.         
+
+        rng: the source of the random numbers (anything with a random()
+        method, e.g. the random module, a random.Random or a numpy Generator)
         
         returns: a new instance of the SimpleVirus class representing the
         offspring of this virus particle. The child should have the same
-        maxBirthProb and clearProb values as this virus. Raises a
-        NoChildException if this virus particle does not reproduce.               
+        maxBirthProb and clearProb values as this virus. Returns None if this
+        virus particle does not reproduce.               
         """
 
-        if self.maxBirthProb * (1 - popDensity) >= random.random():
+        if self.maxBirthProb * (1 - popDensity) >= rng.random():
             return SimpleVirus(self.maxBirthProb,self.clearProb)
         else:
-            raise NoChildException()
+            return None
 
 
 
@@ -83,25 +167,51 @@ class Patient(object):
     and his/her virus populations have no drug resistance.
     """    
 
-    def __init__(self, viruses, maxPop):
+    def __init__(self, numViruses, maxPop, maxBirthProb, clearProb, rng=None,
+                 fast=False):
         """
-        Initialization function, saves the viruses and maxPop parameters as
-        attributes.
+        Initialization function, saves all parameters as attributes. Every
+        SimpleVirus carries the same maxBirthProb and clearProb, so the
+        population is kept as a count plus those two shared probabilities
+        instead of a list of identical objects.
 
-        viruses: the list representing the virus population (a list of
-        SimpleVirus instances)
+        numViruses: the size of the initial virus population (an integer)
 
         maxPop: the maximum virus population for this patient (an integer)
+
+        maxBirthProb: Maximum reproduction probability of the viruses (a float
+        between 0-1)
+
+        clearProb: Maximum clearance probability of the viruses (a float
+        between 0-1)
+
+        rng: the numpy Generator used for every random draw of this patient.
+        A new unseeded Generator is created if it is not given.
+
+        fast: if True, update() uses the mean-field approximation: the
+        population density is taken at the start of the time step instead of
+        after the clearance, so clearance and reproduction can be drawn
+        independently. The density then also counts the viruses cleared in
+        that step, which lowers the equilibrium population by roughly a
+        fraction clearProb (about 30% with clearProb = 0.3). A Patient update
+        is two Binomial draws either way, so here fast only changes the
+        dynamics; it only saves work in TreatedPatient.
         """
-        self.viruses = viruses
+        self.count = numViruses
+        self.maxBirthProb = maxBirthProb
+        self.clearProb = clearProb
         self.maxPop = maxPop
+        if rng is None:
+            rng = np.random.default_rng()
+        self.rng = rng
+        self.fast = fast
         
 
     def getViruses(self):
         """
         Returns the viruses in this Patient.
         """
-        return self.viruses
+        return [SimpleVirus(self.maxBirthProb, self.clearProb)] * self.count
 
 
     def getMaxPop(self):
@@ -117,7 +227,7 @@ class Patient(object):
         returns: The total virus population (an integer)
         """
 
-        return len(self.viruses)       
+        return self.count
 
 
     def update(self):
@@ -125,70 +235,88 @@ class Patient(object):
         Update the state of the virus population in this patient for a single
         time step. update() should execute the following steps in this order:
         
-        - Determine whether each virus particle survives and updates the list
-        of virus particles accordingly.   
+        - Determine whether each virus particle survives and updates the
+        population accordingly.   
         
         - The current population density is calculated. This population density
           value is used until the next call to update() 
         
         - Based on this value of population density, determine whether each 
-          virus particle should reproduce and add offspring virus particles to 
-          the list of viruses in this patient.                    
+          virus particle should reproduce and add the offspring to the
+          population of this patient.                    
+
+        Every SimpleVirus in the population shares the same maxBirthProb and
+        clearProb, so the survivors follow Binomial(count, 1 - clearProb) and
+        the offspring follow Binomial(survivors, maxBirthProb * (1 -
+        popDensity)). The whole update is these two draws, whatever the size
+        of the population. With fast=True, popDensity is count / maxPop at
+        the start of the time step (mean-field approximation).
 
         returns: The total virus population at the end of the update (an
         integer)
         """
-        self.survivorViruses = []
-        self.newViruses = []
-        
-        for i in self.viruses:
-               if not i.doesClear():
-                  self.survivorViruses.append(i)
-        
-        self.popDensity = len(self.survivorViruses) / self.maxPop
-        for i in self.survivorViruses:
-                try:
-                    pot = i.reproduce(self.popDensity)
-                    if pot:
-                        self.newViruses.append(i)
-                except NoChildException:
-                    pass
-        
-        self.viruses = self.survivorViruses + self.newViruses
-        return len(self.viruses)
+        binomial = self.rng.binomial
+        if self.fast:
+            self.popDensity = self.count / self.maxPop
+        survivors = int(binomial(self.count, 1.0 - self.clearProb))
+
+        if not self.fast:
+            self.popDensity = survivors / self.maxPop
+        birthProb = max(0.0, self.maxBirthProb * (1 - self.popDensity))
+        births = int(binomial(survivors, birthProb))
+
+        self.count = survivors + births
+        return self.count
         
 
 
+def runTrialWithoutDrug(seed, numViruses, maxPop, maxBirthProb, clearProb,
+                        fast=False):
+    """
+    Runs one trial of simulationWithoutDrug: instantiates a patient and runs
+    a simulation for 300 timesteps.
+
+    seed: the seed of the random numbers of this trial (a numpy SeedSequence)
+
+    fast: whether the patient uses the mean-field approximation (see Patient)
+
+    returns: the total virus population at every time step (a numpy array of
+    300 values)
+    """
+    patient = Patient(numViruses, maxPop, maxBirthProb, clearProb,
+                      np.random.default_rng(seed), fast)
+    update = patient.update
+    yValues = np.empty(300)
+    for t in range(300):
+        yValues[t] = update()
+    return yValues
+
+
 def simulationWithoutDrug(numViruses, maxPop, maxBirthProb, clearProb,
-                          numTrials):
+                          numTrials, masterSeed=None, fast=False):
     """
     Run the simulation and plot the graph (no drugs are used,
     viruses do not have any drug resistance).    
     For each of numTrials trial, instantiates a patient, runs a simulation
     for 300 timesteps, and plots the average virus population size as a
-    function of time.
+    function of time. Each trial uses its own seed spawned from masterSeed.
+    A trial is only 300 pairs of Binomial draws, so the trials run in this
+    process: starting a pool of worker processes costs more than all of them.
 
     numViruses: number of SimpleVirus to create for patient (an integer)
     maxPop: maximum virus population for patient (an integer)
     maxBirthProb: Maximum reproduction probability (a float between 0-1)        
     clearProb: Maximum clearance probability (a float between 0-1)
     numTrials: number of simulation runs to execute (an integer)
+    masterSeed: seed that makes the simulation reproducible (an integer, or
+    None to use fresh entropy)
+    fast: whether to use the mean-field approximation (see Patient)
     """
-    yValues = []
-    listViruses = []
-    for i in range(numViruses):
-       listViruses.append(SimpleVirus(maxBirthProb,clearProb))
-       
-    for i in range(numTrials):
-        initial = Patient(listViruses, maxPop)
-        for i in range(300):
-            initial.update()
-            if len(yValues) == i:
-                 yValues.append(initial.getTotalPop())
-            else:
-                yValues[i] = yValues[i] + initial.getTotalPop()
-    for y in range(len(yValues)):
-        yValues[y] = yValues[y] / numTrials
+    yValues = np.zeros(300)
+    for seed in np.random.SeedSequence(masterSeed).spawn(numTrials):
+        yValues += runTrialWithoutDrug(seed, numViruses, maxPop, maxBirthProb,
+                                       clearProb, fast)
+    yValues /= numTrials
 
     pylab.plot(yValues, label = "SimpleVirus")
     pylab.title("SimpleVirus simulation")
@@ -203,6 +331,7 @@ class ResistantVirus(SimpleVirus):
     """
     Representation of a virus which can have drug resistance.
     """   
+    __slots__ = ('traits', 'traitBits', 'mask', 'mutProb')
 
     def __init__(self, maxBirthProb, clearProb, resistances, mutProb):
         """
@@ -220,18 +349,42 @@ class ResistantVirus(SimpleVirus):
 
         mutProb: Mutation probability for this virus particle (a float). This is
         the probability of the offspring acquiring or losing resistance to a drug.
+
+        The resistances are stored as two bitmasks (see drugIndex): traits has
+        a bit set for every drug in resistances, and mask has a bit set for
+        every drug this virus particle is resistant to. traitBits holds the
+        bit of each trait separately (a tuple of integers).
         """
 
         SimpleVirus.__init__(self, maxBirthProb,clearProb)
-        self.resistances = resistances
+        self.traits = getDrugMask(resistances)
+        self.traitBits = tuple(int(bit) for bit in getTraitBits(self.traits))
+        self.mask = getDrugMask([d for d in resistances if resistances[d]])
         self.mutProb = mutProb
 
 
     def getResistances(self):
         """
-        Returns the resistances for this virus.
+        Returns the resistances for this virus (a dictionary of drug names
+        mapping to True or False).
+        """
+        resistances = {}
+        for drug, bit in drugIndex.items():
+            if (self.traits >> bit) & 1:
+                resistances[drug] = bool((self.mask >> bit) & 1)
+        return resistances
+
+    def getTraitMask(self):
+        """
+        Returns the bitmask of the drugs this virus has a resistance trait for.
         """
-        return self.resistances
+        return self.traits
+
+    def getResistanceMask(self):
+        """
+        Returns the bitmask of the drugs this virus is resistant to.
+        """
+        return self.mask
 
     def getMutProb(self):
         """
@@ -250,14 +403,12 @@ class ResistantVirus(SimpleVirus):
         returns: True if this virus instance is resistant to the drug, False
         otherwise.
         """
-        if drug in self.resistances:
-            if self.resistances[drug]:
-                return True
-            else:
-                return False
+        if drug not in drugIndex:
+            return False
+        return bool((self.mask >> drugIndex[drug]) & 1)
 
 
-    def reproduce(self, popDensity, activeDrugs):
+    def reproduce(self, popDensity, activeDrugs, rng=random):
         """
         Stochastically determines whether this virus particle reproduces at a
         time step. Called by the update() method in the TreatedPatient class.
@@ -277,8 +428,8 @@ class ResistantVirus(SimpleVirus):
         maxBirthProb and clearProb values as its parent). The offspring virus
         will have the same maxBirthProb, clearProb, and mutProb as the parent.
 
-        For each drug resistance trait of the virus (i.e. each key of
-        self.resistances), the offspring has probability 1-mutProb of
+        For each drug resistance trait of the virus (i.e. each bit of
+        self.traits), the offspring has probability 1-mutProb of
         inheriting that resistance trait from the parent, and probability
         mutProb of switching that resistance trait in the offspring.       
 
@@ -296,33 +447,35 @@ class ResistantVirus(SimpleVirus):
         activeDrugs: a list of the drug names acting on this virus particle
         (a list of strings).
 
+        rng: the source of the random numbers (anything with a random()
+        method, e.g. the random module, a random.Random or a numpy Generator)
+
         returns: a new instance of the ResistantVirus class representing the
         offspring of this virus particle. The child should have the same
-        maxBirthProb and clearProb values as this virus. Raises a
-        NoChildException if this virus particle does not reproduce.
-        """
-        resist = True
-        newResistances = {}
-        for drug in activeDrugs:
-          if not len(self.getResistances()) == 0:
-            if not self.resistances[drug] or not drug in self.resistances:
-              resist = False
-
-        if resist:            
-            if not len(self.resistances) == 0:
-              for drug in self.resistances:
-                  if 1-self.mutProb >= random.random():
-                     newResistances[drug] = self.resistances[drug]
-                     
-                  else:
-                     newResistances[drug] = not self.resistances[drug]
-                              
-            if self.maxBirthProb * (1 - popDensity) >= random.random():
-                return ResistantVirus(self.maxBirthProb,self.clearProb,newResistances,self.mutProb)
-            else:
-                raise NoChildException()
-        else:
-            raise NoChildException()
+        maxBirthProb and clearProb values as this virus. Returns None if this
+        virus particle does not reproduce.
+        """
+        drugMask = findDrugMask(activeDrugs)
+        if drugMask is None or self.mask & drugMask != drugMask:
+            return None
+
+        rand = rng.random
+        if self.maxBirthProb * (1 - popDensity) < rand():
+            return None
+        mutProb = self.mutProb
+        flips = 0
+        for bit in self.traitBits:
+            if rand() < mutProb:
+                flips |= bit
+
+        child = ResistantVirus.__new__(ResistantVirus)
+        child.maxBirthProb = self.maxBirthProb
+        child.clearProb = self.clearProb
+        child.mutProb = mutProb
+        child.traits = self.traits
+        child.traitBits = self.traitBits
+        child.mask = self.mask ^ flips
+        return child
         
         
                 
@@ -333,7 +486,7 @@ class TreatedPatient(Patient):
     virus population can acquire resistance to the drugs he/she takes.
     """
 
-    def __init__(self, viruses, maxPop, prescription):
+    def __init__(self, viruses, maxPop, prescription, rng=None, fast=False):
         """
         Initialization function, saves the viruses and maxPop parameters as
         attributes. Also initializes the list of drugs being administered
@@ -345,37 +498,117 @@ class TreatedPatient(Patient):
         maxPop: The  maximum virus population for this patient (an integer)
         
         prescription: The list of drugs for the treatment, but not implemented until simulation
-        """
 
-        Patient.__init__(self,viruses,maxPop)
+        rng: the numpy Generator used for every random draw of this patient.
+        A new unseeded Generator is created if it is not given.
+
+        fast: if True, update() takes the population density at the start of
+        the time step (mean-field approximation, see Patient)
+
+        The population is stored as a numpy array holding the resistance
+        bitmask of each virus particle (see drugIndex). Every virus shares the
+        same maxBirthProb, clearProb and mutProb, and mutations act on the
+        union of the resistance traits of the initial viruses. A ValueError is
+        raised if the viruses do not all have the same probabilities.
+
+        Each virus has at most one offspring per time step, so a time step at
+        most doubles the population. Two buffers of 2 * len(viruses) entries
+        are allocated here and update() alternates between them instead of
+        allocating new arrays at every time step, growing a buffer only when
+        twice the current population no longer fits in it.
+        """
+
+        if len(viruses) > 0:
+            probs = (viruses[0].getMaxBirthProb(), viruses[0].getClearProb(),
+                     viruses[0].getMutProb())
+            for v in viruses:
+                if (v.getMaxBirthProb(), v.getClearProb(), v.getMutProb()) != probs:
+                    raise ValueError("All the viruses of a TreatedPatient must "
+                                     "have the same maxBirthProb, clearProb "
+                                     "and mutProb")
+            Patient.__init__(self, len(viruses), maxPop, viruses[0].getMaxBirthProb(),
+                             viruses[0].getClearProb(), rng, fast)
+        else:
+            Patient.__init__(self, 0, maxPop, 0.0, 0.0, rng, fast)
+        capacity = 2 * len(viruses)
+        self.buffers = [np.empty(capacity, dtype=np.uint64),
+                        np.empty(capacity, dtype=np.uint64)]
+        self.activeBuffer = 0
+        self.viruses = self.buffers[0][:len(viruses)]
+        self.viruses[:] = [v.getResistanceMask() for v in viruses]
+        self.mutProb = viruses[0].getMutProb() if len(viruses) > 0 else 0.0
+        self.traits = 0
+        for v in viruses:
+            self.traits |= v.getTraitMask()
+        self.traitBits = getTraitBits(self.traits)
         self.prescription = prescription
         self.Prescriptions = []
+        self.prescriptionSet = frozenset()
+        self.drugMask = np.uint64(0)
+        self.resistCache = {}
 
 
     def addPrescription(self, newDrugs):
         """
-        Administer a drug to this patient. After a prescription is added, the
-        drug acts on the virus population for all subsequent time steps. If the
-        newDrug is already prescribed to this patient, the method has no effect.
+        Administer drugs to this patient. After a prescription is added, the
+        drugs act on the virus population for all subsequent time steps. Drugs
+        already prescribed to this patient are ignored.
 
-        newDrug: The name of the drug to administer to the patient (a string).
+        newDrugs: The name of the drug to administer to the patient (a
+        string), or the names of several drugs (a list of strings).
 
-        postcondition: The list of drugs being administered to a patient is updated
+        postcondition: The list of drugs being administered to a patient, its
+        set and its bitmask are updated
         """
+        if isinstance(newDrugs, str):
+            newDrugs = [newDrugs]
         for d in newDrugs:
-           if not newDrugs in self.Prescriptions:
-              self.Prescriptions.append(newDrugs)
+           if d not in self.prescriptionSet:
+              self.Prescriptions.append(d)
+              self.prescriptionSet = frozenset(self.Prescriptions)
+        self.drugMask = np.uint64(getDrugMask(self.Prescriptions))
 
 
     def getPrescriptions(self):
         """
         Returns the drugs that are being administered to this patient.
 
-        returns: The list of drug names (strings) being administered to this
-        patient.
+        returns: A copy of the list of drug names (strings) being administered
+        to this patient. Use addPrescription() to change it.
         """
 
-        return self.Prescriptions
+        return list(self.Prescriptions)
+
+
+    def getViruses(self):
+        """
+        Returns the viruses in this TreatedPatient (a list of ResistantVirus
+        instances rebuilt from the resistance bitmasks). Viruses with the same
+        resistances share one instance.
+        """
+        traitBits = tuple(int(bit) for bit in self.traitBits)
+        byMask = {}
+        viruses = []
+        for mask in self.viruses.tolist():
+            virus = byMask.get(mask)
+            if virus is None:
+                virus = byMask[mask] = ResistantVirus.__new__(ResistantVirus)
+                virus.maxBirthProb = self.maxBirthProb
+                virus.clearProb = self.clearProb
+                virus.mutProb = self.mutProb
+                virus.traits = self.traits
+                virus.traitBits = traitBits
+                virus.mask = mask
+            viruses.append(virus)
+        return viruses
+
+
+    def getResistanceMasks(self):
+        """
+        Returns the viruses in this TreatedPatient as a numpy array with the
+        resistance bitmask of each virus particle (see drugIndex).
+        """
+        return self.viruses.copy()
 
 
     def getResistPop(self, drugResist):
@@ -387,17 +620,20 @@ class TreatedPatient(Patient):
         of strings - e.g. ['guttagonol'] or ['guttagonol', 'srinol'])
 
         returns: The population of viruses (an integer) with resistances to all
-        drugs in the drugResist list.
-        """
-        self.resistantViruses = 0
-        for i in self.viruses:
-            resists = True
-            for d in drugResist:
-                 if not i.isResistantTo(d):
-                     resists = False
-            if resists:
-                self.resistantViruses += 1
-        return self.resistantViruses
+        drugs in the drugResist list. The result is cached until the next
+        call to update().
+        """
+        query = findDrugMask(drugResist)
+        if query is None:
+            return 0
+        if query == 0:
+            return self.count
+        resistPop = self.resistCache.get(query)
+        if resistPop is None:
+            mask = np.uint64(query)
+            resistPop = int(np.count_nonzero((self.viruses & mask) == mask))
+            self.resistCache[query] = resistPop
+        return resistPop
         
 
 
@@ -418,42 +654,99 @@ class TreatedPatient(Patient):
           The list of drugs being administered should be accounted for in the
           determination of whether each virus particle reproduces.
 
+        With fast=True the population density is taken at the start of the
+        time step instead (mean-field approximation).
+
+        Both steps run as numpy array operations that draw the clearance,
+        reproduction and mutation numbers of every virus with a single
+        rng.random() call and compact the survivors and the offspring straight
+        from the current population, without an intermediate survivor array.
+
         returns: The total virus population at the end of the update (an
         integer)
         """
 
-        self.survivorViruses = []
-        self.newViruses = []
+        rng = self.rng
+        viruses = self.viruses
+        maxPop = self.maxPop
+        traitBits = self.traitBits
+        self.activeBuffer = 1 - self.activeBuffer
+        buffer = self.buffers[self.activeBuffer]
+        if len(buffer) < 2 * len(viruses):
+            buffer = np.empty(max(2 * len(viruses), 2 * len(buffer)), dtype=np.uint64)
+            self.buffers[self.activeBuffer] = buffer
+        drugMask = self.drugMask
 
-        for i in self.viruses:
-               if not i.doesClear():
-                  self.survivorViruses.append(i)
-        
+        draws = rng.random((len(viruses), 2 + len(traitBits)))
+        survives = draws[:, 0] > self.clearProb
+        numSurvivors = np.count_nonzero(survives)
 
-        self.popDensity = len(self.survivorViruses) / self.maxPop
-        
-        for i in self.survivorViruses:
-            reproductiv = True
-            for d in self.Prescriptions:
-                if not len(i.getResistances()) == 0:
-                   if not i.resistances[d]:
-                      reproductiv = False
-            try:
-              if reproductiv or len(i.getResistances()) == 0:
-                  try:
-                      pot = i.reproduce(self.popDensity, self.Prescriptions)
-                      if pot:
-                          self.newViruses.append(pot)
-                  except NoChildException:
-                      pass
-            except NoChildException:
-                      pass
-        
-        self.viruses = self.survivorViruses + self.newViruses
-        return len(self.viruses)
+        if self.fast:
+            birthProb = self.maxBirthProb * (1 - len(viruses) / maxPop)
+        else:
+            birthProb = self.maxBirthProb * (1 - numSurvivors / maxPop)
+        reproduces = survives & (draws[:, 1] < birthProb)
+        if drugMask:
+            reproduces &= (viruses & drugMask) == drugMask
+        count = numSurvivors + np.count_nonzero(reproduces)
+        np.compress(survives, viruses, out=buffer[:numSurvivors])
+        offspring = np.compress(reproduces, viruses, out=buffer[numSurvivors:count])
+
+        mutations = draws[reproduces, 2:] < self.mutProb
+        offspring ^= (mutations * traitBits).sum(axis=1, dtype=np.uint64)
+
+        if self.fast:
+            self.popDensity = len(viruses) / maxPop
+        else:
+            self.popDensity = numSurvivors / maxPop
+        self.count = count
+        self.viruses = buffer[:count]
+        self.resistCache.clear()
+        return count
         
 
-def simulationWithDrug(virus, patient, numTrials):
+parallelWork = 10 ** 6
+"""
+Smallest numTrials * maxPop for which simulationWithDrug runs its trials on a
+pool of worker processes. A trial costs about 8 ms plus 2.5 us per virus of
+maxPop, so this is several seconds of work, enough to pay for starting the
+workers (close to a second when they are spawned rather than forked).
+"""
+
+def runTrialWithDrug(seed, virus, numViruses, maxPop, prescription, fast=False):
+    """
+    Runs one trial of simulationWithDrug: instantiates a treated patient with
+    numViruses copies of virus, runs a simulation for 150 timesteps, adds the
+    prescription, and runs the simulation for an additional 150 timesteps.
+    Defined at module level so it can be sent to the worker processes.
+
+    seed: the seed of the random numbers of this trial (a numpy SeedSequence)
+
+    fast: whether the patient uses the mean-field approximation (see Patient)
+
+    returns: a numpy array of shape (300, 2) with the total virus population
+    and the prescription-resistant virus population at every time step
+    """
+    patient = TreatedPatient([virus] * numViruses, maxPop, [],
+                             np.random.default_rng(seed), fast)
+    update = patient.update
+    getResistPop = patient.getResistPop
+    yValues = np.empty((300, 2))
+    prescriptions = patient.getPrescriptions()
+    for t in range(150):
+        yValues[t, 0] = update()
+        yValues[t, 1] = getResistPop(prescriptions)
+
+    patient.addPrescription(prescription)
+
+    prescriptions = patient.getPrescriptions()
+    for t in range(150, 300):
+        yValues[t, 0] = update()
+        yValues[t, 1] = getResistPop(prescriptions)
+    return yValues
+
+
+def simulationWithDrug(virus, patient, numTrials, masterSeed=None, fast=False):
     """
     Runs simulations and plots graphs. Viruses have drug resistance and the 
     patient has a prescription.
@@ -462,54 +755,36 @@ def simulationWithDrug(virus, patient, numTrials):
     150 timesteps, adds the prescription, and runs the simulation for an additional
     150 timesteps.  At the end plots the average virus population size
     (for both the total virus population and the drug-resistant virus
-    population) as a function of time.
+    population) as a function of time. Each trial uses its own seed spawned
+    from masterSeed. The trials are independent, so when there is more than
+    one CPU and numTrials * maxPop reaches parallelWork they run on a pool of
+    worker processes; smaller runs stay in this process, where they finish
+    before a pool would have started.
 
     numTrials: number of simulation runs to execute (an integer)
+
+    masterSeed: seed that makes the simulation reproducible (an integer, or
+    None to use fresh entropy)
+
+    fast: whether to use the mean-field approximation (see Patient)
     
     """
-    yValues = []
-    yDrugValues = []
-    listViruses = []
-    for v in patient.viruses:
-
-        listViruses.append(virus)     
-            
-    for t in range(numTrials):
-      p = TreatedPatient(patient.viruses, patient.maxPop, [])
-
-      for i in range(150):
-        p.update()
-        for adder in range(1):
-            if len(yValues) == i:
-               yValues.append(p.getTotalPop())
-            else:
-               yValues[i] = yValues[i] + p.getTotalPop()
-        for adder in range(1):
-            if len(yDrugValues) == i:
-               yDrugValues.append(p.getResistPop(patient.getPrescriptions()))
-            else:
-               yDrugValues[i] = yDrugValues[i] + p.getResistPop(patient.getPrescriptions())
-      
-      for d in patient.prescription:
-         p.addPrescription(d)
-         
-      for i in range(150):
-        p.update()
-        for adder in range(1):
-            if len(yValues) == i+150:
-               yValues.append(p.getTotalPop())
-            else:
-               yValues[i+150] = yValues[i+150] + p.getTotalPop()
-        for adder in range(1):
-            if len(yDrugValues) == i+150:
-               yDrugValues.append(p.getResistPop(p.getPrescriptions()))
-            else:
-               yDrugValues[i+150] = yDrugValues[i+150] + p.getResistPop(p.getPrescriptions())
-   
-    for y in range(len(yValues)):
-       yValues[y] = yValues[y] / numTrials
-    for e in range(len(yDrugValues)):
-       yDrugValues[e] = yDrugValues[e] / numTrials   
+    seeds = np.random.SeedSequence(masterSeed).spawn(numTrials)
+    args = (virus, patient.getTotalPop(), patient.getMaxPop(),
+            patient.prescription, fast)
+    totals = np.zeros((300, 2))
+    if (os.cpu_count() or 1) > 1 and numTrials * patient.getMaxPop() >= parallelWork:
+        with ProcessPoolExecutor(max_workers=os.cpu_count(), initializer=loadDrugIndex,
+                                 initargs=(dict(drugIndex),)) as executor:
+            trials = [executor.submit(runTrialWithDrug, seed, *args)
+                      for seed in seeds]
+            for trial in trials:
+                totals += trial.result()
+    else:
+        for seed in seeds:
+            totals += runTrialWithDrug(seed, *args)
+    totals /= numTrials
+    yValues, yDrugValues = totals.T
 
         
     pylab.plot(yValues, label = "ResistantVirus population")
@@ -525,203 +800,212 @@ def simulationWithDrug(virus, patient, numTrials):
 
 #User Interface#
 
-print("------------Welcome to the Virus Growth Simulation App!-------")
-print("")
-print("This program permits the user to create personalized Virus objects, as well as Patient objects, in order to test 100 simulations of virus growth with multiple variables and show the results in a graph. The graphs take some time to load.")
-print("")
-print("-Simple Virus: Without drug resistance, this virus reproduces by itself in a time step. Its properties are: Maximun Reproduction Probability, and Elimination Probability.")
-print("")
-print("-Patient: Representation of a simplified patient. The patient does not take any drugs and his/her virus populations have no drug resistance. It has a starting virus population and a max population variable.")
-print("")
-print("-Resistant Virus: A virus with a list of drug resistance(s) and mutation probability (which may or not alter its drug resistances after reproduction).")
-print("")
-print("-Treated Patient: A Patient object treated with one or more drugs. The prescription eliminates unresistant viruses, but Resistant viruses may acquire or lose drug resistances in the process.")
-print("")
-
-navigator = 4
-while navigator != 1 or 2 or 3: 
-    navigator = int(input("Enter 1 to create a simulation with Simple Viruses and a Patient, or enter 2 to experiment with Resistant Viruses and a Treated Patient. To exit, enter 3: "))
+if __name__ == "__main__":
+    print("------------Welcome to the Virus Growth Simulation App!-------")
+    print("")
+    print("This program permits the user to create personalized Virus objects, as well as Patient objects, in order to test 100 simulations of virus growth with multiple variables and show the results in a graph. The graphs take some time to load.")
+    print("")
+    print("-Simple Virus: Without drug resistance, this virus reproduces by itself in a time step. Its properties are: Maximun Reproduction Probability, and Elimination Probability.")
+    print("")
+    print("-Patient: Representation of a simplified patient. The patient does not take any drugs and his/her virus populations have no drug resistance. It has a starting virus population and a max population variable.")
+    print("")
+    print("-Resistant Virus: A virus with a list of drug resistance(s) and mutation probability (which may or not alter its drug resistances after reproduction).")
+    print("")
+    print("-Treated Patient: A Patient object treated with one or more drugs. The prescription eliminates unresistant viruses, but Resistant viruses may acquire or lose drug resistances in the process.")
     print("")
-    if navigator == 1:
-       print("1. Creating our Simple Virus")
-       print("")
-       maxBirthProb = -1
-       while maxBirthProb < 0 or maxBirthProb > 1:
-          try:
-             maxBirthProb = float(input("Enter the Maximun Reproduction Probability (float between 0 and 1): "))
-             if maxBirthProb < 0 or maxBirthProb > 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")
-
-       clearProb = -1
-       while clearProb < 0 or clearProb > 1:
-          try:
-             clearProb = float(input("Enter the Elimination Probability (float number between 0 and 1): "))
-             if clearProb < 0 or clearProb > 1 :
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")        
-
-       ourSimpleVirus = SimpleVirus(maxBirthProb, clearProb)
-       print("--------------------------------------------------------------")
-       print("Simple Virus creation was successful!")
-       print("Maximun Reproduction Probability: ",str(maxBirthProb)," / ","Elimination Probability: ",str(clearProb))
-       print("")
-    
-       print("2. Creating our Patient")
-       print("")
-       numVirus = 0
-       listVirus = []
-       while numVirus < 1:
-          try:
-             numVirus = int(input("Enter the starting Simple Virus population (int number greater than 0. Recommended to be lower than 400): "))      
-             if numVirus < 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")    
-       for i in range(numVirus):
-          listVirus.append(ourSimpleVirus)
-       print("")
-       maxPop = 0
-       while maxPop < 1:
-          try:
-             maxPop = int(input("Enter the maximun Simple Virus population (int number greater than 0. Recommended to be lower than 400): "))      
-             if maxPop < 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")    
-
-       ourPatient = Patient(listVirus,maxPop)
-       print("--------------------------------------------------------------")
-       print("Patient creation was successful")
-       print("Initial Simple Virus population: ",str(numVirus)," / ","Maximun Simple Virus population: ",str(maxPop))
-       print("")
-       print("The program performs 100 simulations and takes the Average Virus Population of all of them at every Time Step. Increasing averages indicate virus growth in the patient over time, while decreasing averages indicate virus decrease over time.")
-       simulationWithoutDrug(numVirus, maxPop, maxBirthProb, clearProb,100)
-       print("")
-       navigator = 4
-    
-    if navigator == 2:
-       print("1. Creating our Resistant Virus")
-       print("")
-       maxBirthProb = -1
-       while maxBirthProb < 0 or maxBirthProb > 1:
-          try:
-             maxBirthProb = float(input("Enter the Maximun Reproduction Probability (float between 0 and 1): "))
-             if maxBirthProb < 0 or maxBirthProb > 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")
-
-       clearProb = -1
-       while clearProb < 0 or clearProb > 1:
-          try:
-             clearProb = float(input("Enter the Elimination Probability (float number between 0 and 1): "))
-             if clearProb < 0 or clearProb > 1 :
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")  
-       
-       resistances = {}
-       resistanceAdded = "x"
-       while resistanceAdded != "0":
-           resistanceAdded = str(input("Write the name of the drug you want the virus to be initially resistant to (it can be any name. Some examples: amoxicillin, doxycycline, guttagonol, etc.). Enter 0 to stop adding drugs: "))
-           if resistanceAdded != "0":
-               resistances[resistanceAdded] = True
-             
-       mutProb = -1
-       while mutProb < 0 or mutProb > 1:
-          try:
-             mutProb = float(input("Enter the Mutation Probability (float number between 0 and 1): "))
-             if mutProb < 0 or mutProb > 1 :
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")                     
-       ourResistantVirus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)   
-       print("--------------------------------------------------------------")
-       print("Resistant Virus creation was successful!")
-       print("Maximun Reproduction Probability: ",str(maxBirthProb)," / ","Elimination Probability: ",str(clearProb)," / ","Drug Resistances: ",str(resistances)," / ","Mutation Probability: ",str(mutProb))
-       print("")       
-
-       print("2. Creating our Treated Patient")
-       print("")
-       numVirus = 0
-       listVirus = []
-       while numVirus < 1:
-          try:
-             numVirus = int(input("Enter the starting Resistant Virus population (int number greater than 0. Recommended to be lower than 400): "))      
-             if numVirus < 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")    
-             
-       for i in range(numVirus):
-          listVirus.append(ourResistantVirus)
-          
-       print("")
-       maxPop = 0
-       while maxPop < 1:
-          try:
-             maxPop = int(input("Enter the maximun Resistant Virus population (int number greater than 0. Recommended to be lower than 400): "))      
-             if maxPop < 1:
-                print("Please enter a valid number")
-                print("")
-          except ValueError:
-             print("Please enter a valid number")
-             print("")    
-
-       drugAdded = "x"
-       prescription = []
-       while drugAdded != "0":
-          drugAdded = str(input("Write the name of the drug you want to add to the Patient's prescription (it can be any name, and it kills viruses that don't have a resistance with the EXACT name. Some examples: amoxicillin, doxycycline, guttagonol, etc.). Enter 0 to stop adding drugs: "))
-          if drugAdded != "0":
-             prescription.append(drugAdded)
-    
-       ourTreatedPatient = TreatedPatient(listVirus,maxPop,prescription)
-       
-       for d in prescription:
-           if d not in ourResistantVirus.getResistances():
-              ourResistantVirus.resistances[d] = False
-       
-    
-       print("--------------------------------------------------------------")
-       print("Treated Patient creation was successful")
-       print("Initial Resistant Virus population: ",str(numVirus)," / ","Maximun Simple Virus population: ",str(maxPop)," / ","Prescription: ",str(prescription))   
-       print("")
-       print("This is a graph of the average results of 100 simulations with two parts. First, from time steps 0 to 150, the patient starts without prescription. Then, since time step 150, the prescription is added to fight the viruses. The graph illustrates its efficiency. The blue line represents the entire virus population, and the orange line represents the virus population resistant to the prescription.")
-       simulationWithDrug(ourResistantVirus, ourTreatedPatient, 100)
-       print("")
-    
-       navigator = 4
-       
-    if navigator == 3:
-       sys.exit("Thanks for using the Virus Growth Simulation App!")
-
-
-
-
-
-
-
 
-#simulationWithDrug(100, 1000, 0.1, 0.05, {'guttagonol': False},0.005, 10)
-#simulationWithDrug(1, 10, 1.0, 0.0, {}, 1.0, 5)
-#simulationWithDrug(1, 20, 1.0, 0.0, {"guttagonol": True}, 1.0, 5)                #done
-#simulationWithDrug(75, 100, .8, 0.1, {"guttagonol": True}, 0.8, 1)
\ No newline at end of file
+    navigator = 4
+    while navigator != 1 or 2 or 3: 
+        navigator = int(input("Enter 1 to create a simulation with Simple Viruses and a Patient, or enter 2 to experiment with Resistant Viruses and a Treated Patient. To exit, enter 3: "))
+        print("")
+        if navigator == 1:
+           print("1. Creating our Simple Virus")
+           print("")
+           maxBirthProb = -1
+           while maxBirthProb < 0 or maxBirthProb > 1:
+              try:
+                 maxBirthProb = float(input("Enter the Maximun Reproduction Probability (float between 0 and 1): "))
+                 if maxBirthProb < 0 or maxBirthProb > 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")
+
+           clearProb = -1
+           while clearProb < 0 or clearProb > 1:
+              try:
+                 clearProb = float(input("Enter the Elimination Probability (float number between 0 and 1): "))
+                 if clearProb < 0 or clearProb > 1 :
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")        
+
+           ourSimpleVirus = SimpleVirus(maxBirthProb, clearProb)
+           print("--------------------------------------------------------------")
+           print("Simple Virus creation was successful!")
+           print("Maximun Reproduction Probability: ",str(maxBirthProb)," / ","Elimination Probability: ",str(clearProb))
+           print("")
+
+           print("2. Creating our Patient")
+           print("")
+           numVirus = 0
+           while numVirus < 1:
+              try:
+                 numVirus = int(input("Enter the starting Simple Virus population (int number greater than 0. Recommended to be lower than 400): "))      
+                 if numVirus < 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")    
+           print("")
+           maxPop = 0
+           while maxPop < 1:
+              try:
+                 maxPop = int(input("Enter the maximun Simple Virus population (int number greater than 0. Recommended to be lower than 400): "))      
+                 if maxPop < 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")    
+
+           ourPatient = Patient(numVirus,maxPop,maxBirthProb,clearProb)
+           print("--------------------------------------------------------------")
+           print("Patient creation was successful")
+           print("Initial Simple Virus population: ",str(numVirus)," / ","Maximun Simple Virus population: ",str(maxPop))
+           print("")
+           print("The program performs 100 simulations and takes the Average Virus Population of all of them at every Time Step. Increasing averages indicate virus growth in the patient over time, while decreasing averages indicate virus decrease over time.")
+           simulationWithoutDrug(numVirus, maxPop, maxBirthProb, clearProb,100)
+           print("")
+           navigator = 4
+
+        if navigator == 2:
+           drugIndex.clear()
+           print("1. Creating our Resistant Virus")
+           print("")
+           maxBirthProb = -1
+           while maxBirthProb < 0 or maxBirthProb > 1:
+              try:
+                 maxBirthProb = float(input("Enter the Maximun Reproduction Probability (float between 0 and 1): "))
+                 if maxBirthProb < 0 or maxBirthProb > 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")
+
+           clearProb = -1
+           while clearProb < 0 or clearProb > 1:
+              try:
+                 clearProb = float(input("Enter the Elimination Probability (float number between 0 and 1): "))
+                 if clearProb < 0 or clearProb > 1 :
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")  
+
+           resistances = {}
+           resistanceAdded = "x"
+           while resistanceAdded != "0":
+               resistanceAdded = str(input("Write the name of the drug you want the virus to be initially resistant to (it can be any name. Some examples: amoxicillin, doxycycline, guttagonol, etc.). Enter 0 to stop adding drugs: "))
+               if resistanceAdded != "0":
+                   resistances[resistanceAdded] = True
+
+           mutProb = -1
+           while mutProb < 0 or mutProb > 1:
+              try:
+                 mutProb = float(input("Enter the Mutation Probability (float number between 0 and 1): "))
+                 if mutProb < 0 or mutProb > 1 :
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")                     
+           try:
+              ourResistantVirus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
+           except ValueError as error:
+              print(str(error) + ". Please start again with fewer drugs.")
+              print("")
+              navigator = 4
+              continue
+           print("--------------------------------------------------------------")
+           print("Resistant Virus creation was successful!")
+           print("Maximun Reproduction Probability: ",str(maxBirthProb)," / ","Elimination Probability: ",str(clearProb)," / ","Drug Resistances: ",str(resistances)," / ","Mutation Probability: ",str(mutProb))
+           print("")       
+
+           print("2. Creating our Treated Patient")
+           print("")
+           numVirus = 0
+           while numVirus < 1:
+              try:
+                 numVirus = int(input("Enter the starting Resistant Virus population (int number greater than 0. Recommended to be lower than 400): "))      
+                 if numVirus < 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")    
+
+           print("")
+           maxPop = 0
+           while maxPop < 1:
+              try:
+                 maxPop = int(input("Enter the maximun Resistant Virus population (int number greater than 0. Recommended to be lower than 400): "))      
+                 if maxPop < 1:
+                    print("Please enter a valid number")
+                    print("")
+              except ValueError:
+                 print("Please enter a valid number")
+                 print("")    
+
+           drugAdded = "x"
+           prescription = []
+           while drugAdded != "0":
+              drugAdded = str(input("Write the name of the drug you want to add to the Patient's prescription (it can be any name, and it kills viruses that don't have a resistance with the EXACT name. Some examples: amoxicillin, doxycycline, guttagonol, etc.). Enter 0 to stop adding drugs: "))
+              if drugAdded != "0":
+                 prescription.append(drugAdded)
+
+           for d in prescription:
+               if d not in resistances:
+                  resistances[d] = False
+           try:
+              ourResistantVirus = ResistantVirus(maxBirthProb, clearProb, resistances, mutProb)
+           except ValueError as error:
+              print(str(error) + ". Please start again with fewer drugs.")
+              print("")
+              navigator = 4
+              continue
+           listVirus = [ourResistantVirus] * numVirus
+
+           ourTreatedPatient = TreatedPatient(listVirus,maxPop,prescription)
+
+
+           print("--------------------------------------------------------------")
+           print("Treated Patient creation was successful")
+           print("Initial Resistant Virus population: ",str(numVirus)," / ","Maximun Simple Virus population: ",str(maxPop)," / ","Prescription: ",str(prescription))   
+           print("")
+           print("This is a graph of the average results of 100 simulations with two parts. First, from time steps 0 to 150, the patient starts without prescription. Then, since time step 150, the prescription is added to fight the viruses. The graph illustrates its efficiency. The blue line represents the entire virus population, and the orange line represents the virus population resistant to the prescription.")
+           simulationWithDrug(ourResistantVirus, ourTreatedPatient, 100)
+           print("")
+
+           navigator = 4
+
+        if navigator == 3:
+           sys.exit("Thanks for using the Virus Growth Simulation App!")
+
+
+
+
+
+
+
+
+    #simulationWithDrug(100, 1000, 0.1, 0.05, {'guttagonol': False},0.005, 10)
+    #simulationWithDrug(1, 10, 1.0, 0.0, {}, 1.0, 5)
+    #simulationWithDrug(1, 20, 1.0, 0.0, {"guttagonol": True}, 1.0, 5)                #done
+    #simulationWithDrug(75, 100, .8, 0.1, {"guttagonol": True}, 0.8, 1)
\ No newline at end of file
@@ -0,0 +1,59 @@
+import unittest
+
+import matplotlib
+matplotlib.use("Agg")
+import numpy as np
+
+from VirusGrowthSimulation import (ResistantVirus, TreatedPatient, drugIndex,
+                                   getDrugMask)
+
+
+class TreatedPatientTest(unittest.TestCase):
+
+    def makePatient(self, seed=None):
+        virus = ResistantVirus(0.1, 0.05, {'a': True, 'b': False}, 0.005)
+        return TreatedPatient([virus] * 100, 1000, ['a'],
+                              np.random.default_rng(seed))
+
+    def testAddPrescriptionName(self):
+        patient = self.makePatient()
+        patient.addPrescription('a')
+        self.assertEqual(patient.getPrescriptions(), ['a'])
+
+    def testAddPrescriptionList(self):
+        patient = self.makePatient()
+        patient.addPrescription(['a', 'b'])
+        patient.addPrescription(['a'])
+        self.assertEqual(patient.getPrescriptions(), ['a', 'b'])
+        patient.getPrescriptions().append('c')
+        self.assertEqual(patient.getPrescriptions(), ['a', 'b'])
+
+    def testResistPopUnknownDrug(self):
+        patient = self.makePatient()
+        self.assertEqual(patient.getResistPop(['a']), 100)
+        self.assertEqual(patient.getResistPop(['a', 'unknown']), 0)
+        self.assertNotIn('unknown', drugIndex)
+
+    def testSeededUpdate(self):
+        counts = []
+        for i in range(2):
+            patient = self.makePatient(seed=7)
+            patient.addPrescription('b')
+            counts.append([patient.update() for t in range(50)])
+        self.assertEqual(counts[0], counts[1])
+
+    def testGetViruses(self):
+        patient = self.makePatient()
+        viruses = patient.getViruses()
+        self.assertEqual(len(viruses), 100)
+        self.assertTrue(viruses[0].isResistantTo('a'))
+        self.assertEqual(viruses[0].getResistanceMask(), getDrugMask(['a']))
+
+    def testMixedProbabilities(self):
+        first = ResistantVirus(0.1, 0.05, {'a': True}, 0.005)
+        second = ResistantVirus(0.2, 0.05, {'a': True}, 0.005)
+        self.assertRaises(ValueError, TreatedPatient, [first, second], 1000, [])
+
+
+if __name__ == "__main__":
+    unittest.main()